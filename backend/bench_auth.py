@@ -0,0 +1,47 @@
+"""
+Measure per-request auth overhead of get_current_user.
+
+"baseline" reproduces the original path: jwt.decode plus a lookup in an
+in-memory users dict. "uncached" clears the verified token cache before
+every call (jwt.decode plus the SQLite user lookup). "cached" reuses the
+cache.
+
+    python bench_auth.py --iterations 20000
+"""
+import argparse
+import timeit
+
+import jwt
+from fastapi.security import HTTPAuthorizationCredentials
+
+import main
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmark token verification")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    token = main.create_access_token(data={"sub": "admin@example.com", "role": "admin"})
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    users = {username: main.get_user(username) for username, _, _ in main.DEMO_USERS}
+
+    def baseline():
+        payload = jwt.decode(credentials.credentials, main.SECRET_KEY, algorithms=[main.ALGORITHM])
+        return users[payload.get("sub")]
+
+    def uncached():
+        main._token_cache.clear()
+        main.get_current_user(credentials)
+
+    def cached():
+        main.get_current_user(credentials)
+
+    for name, fn in (("baseline", baseline), ("uncached", uncached), ("cached", cached)):
+        fn()
+        seconds = timeit.timeit(fn, number=args.iterations)
+        print(f"{name:<9} {seconds / args.iterations * 1e6:8.1f} us/request")
+
+
+if __name__ == "__main__":
+    run()
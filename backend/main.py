@@ -6,6 +6,12 @@ import sqlite3
 import qrcode
 import io
 import base64
+import time
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from datetime import datetime, timedelta
 from fastapi import FastAPI, HTTPException, Depends
@@ -16,6 +22,10 @@ from passlib.context import CryptContext
 from dotenv import load_dotenv
 from web3 import Web3
 
+try:
+    import fcntl
+except ImportError:  # Windows dev machines: fall back to the in-process lock only
+    fcntl = None
 
 # ─── Auth setup ───────────────────────────────
 SECRET_KEY = os.getenv("SECRET_KEY", "secret")
@@ -43,14 +53,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Optional traffic capture for replay load tests (see replay.py)
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH")
+if TRAFFIC_CAPTURE_PATH:
+    from traffic_capture import TrafficCaptureMiddleware
+    app.add_middleware(
+        TrafficCaptureMiddleware,
+        path=TRAFFIC_CAPTURE_PATH,
+        salt=os.getenv("TRAFFIC_CAPTURE_SALT", SECRET_KEY),
+    )
+
 # Blockchain setup (safe production version)
 
 w3 = None
 contract = None
 account = None
+chain_id = 11155111
 
 def init_web3():
-    global w3, contract, account
+    global w3, contract, account, chain_id
 
     if w3 is not None:
         return
@@ -58,19 +79,23 @@ def init_web3():
     infura_key = os.getenv("INFURA_API_KEY")
     private_key = os.getenv("PRIVATE_KEY")
     contract_address = os.getenv("CONTRACT_ADDRESS")
+    # WEB3_PROVIDER_URL points the backend at another chain, e.g. a local hardhat node
+    provider_url = os.getenv("WEB3_PROVIDER_URL")
 
-    if not infura_key or not private_key or not contract_address:
+    if not (provider_url or infura_key) or not private_key or not contract_address:
         logger.warning("Blockchain environment variables missing.")
         return
 
     try:
-        provider_url = f"https://sepolia.infura.io/v3/{infura_key}"
+        provider_url = provider_url or f"https://sepolia.infura.io/v3/{infura_key}"
         w3 = Web3(Web3.HTTPProvider(provider_url))
 
         if not w3.is_connected():
             logger.error("Web3 not connected.")
+            w3 = None
             return
 
+        chain_id = w3.eth.chain_id
         account = w3.eth.account.from_key(private_key)
 
         with open("artifacts/contracts/ProductRegistry.sol/ProductRegistry.json") as f:
@@ -78,10 +103,13 @@ def init_web3():
 
         contract = w3.eth.contract(address=contract_address, abi=abi)
 
-        logger.info("Connected to Sepolia successfully.")
+        logger.info(f"Connected to chain {chain_id} successfully.")
 
     except Exception as e:
         logger.error(f"Blockchain initialization failed: {e}")
+        w3 = None
+        contract = None
+        account = None
 
 # SQLite setup
 DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "products.db"))
@@ -89,6 +117,8 @@ def init_db():
     try:
         conn = sqlite3.connect(DB_PATH, check_same_thread=False)
         c = conn.cursor()
+        # WAL lets every worker process read while another one writes
+        c.execute("PRAGMA journal_mode=WAL")
         c.execute("""
             CREATE TABLE IF NOT EXISTS products (
                 product_id TEXT PRIMARY KEY,
@@ -100,6 +130,19 @@ def init_db():
                 tx_hash TEXT
             )
         """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                hashed_password TEXT NOT NULL,
+                role TEXT NOT NULL
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS revoked_tokens (
+                digest TEXT PRIMARY KEY,
+                exp INTEGER NOT NULL
+            )
+        """)
         conn.commit()
         conn.close()
         logger.info(f"✅ Database initialized at {DB_PATH}")
@@ -125,28 +168,85 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
-fake_users_db = {
-    "admin@example.com": {
-        "username": "admin@example.com",
-        "hashed_password": pwd_context.hash("admin"),
-        "role": "admin"
-    },
-    "producer@example.com": {
-        "username": "producer@example.com",
-        "hashed_password": pwd_context.hash("producer"),
-        "role": "producer"
-    },
-    "seller@example.com": {
-        "username": "seller@example.com",
-        "hashed_password": pwd_context.hash("seller"),
-        "role": "seller"
-    },
-    "consumer@example.com": {
-        "username": "consumer@example.com",
-        "hashed_password": pwd_context.hash("consumer"),
-        "role": "consumer"
-    }
-}
+# Users live in SQLite so every worker process sees the same accounts.
+# Demo accounts are only hashed when missing, not on every import.
+DEMO_USERS = [
+    ("admin@example.com", "admin", "admin"),
+    ("producer@example.com", "producer", "producer"),
+    ("seller@example.com", "seller", "seller"),
+    ("consumer@example.com", "consumer", "consumer"),
+]
+
+def init_users():
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT username FROM users")
+        existing = {row["username"] for row in c.fetchall()}
+        for username, password, role in DEMO_USERS:
+            if username in existing:
+                continue
+            c.execute(
+                "INSERT OR IGNORE INTO users (username, hashed_password, role) VALUES (?, ?, ?)",
+                (username, pwd_context.hash(password), role)
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+init_users()
+
+# One long-lived connection per thread for the per-request user lookup
+_thread_db = threading.local()
+
+def get_user(username):
+    conn = getattr(_thread_db, "conn", None)
+    if conn is None:
+        conn = _thread_db.conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT username, hashed_password, role FROM users WHERE username = ?", (username,))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+# Signer coordination
+# All workers sign with the same wallet, so reading the pending nonce, signing
+# and sending a transaction is serialized with an OS file lock. The next worker
+# only reads the nonce after the previous send has reached the node.
+SIGNER_LOCK_PATH = os.getenv("SIGNER_LOCK_PATH", DB_PATH + ".signer.lock")
+_signer_thread_lock = threading.Lock()
+
+@contextmanager
+def signer_lock():
+    with _signer_thread_lock:
+        with open(SIGNER_LOCK_PATH, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def send_contract_tx(fn_name, *args):
+    """Sign and send a contract call while holding the signer lock shared by all workers."""
+    init_web3()
+    if contract is None or account is None:
+        raise Exception("Blockchain is not configured")
+    contract_fn = getattr(contract.functions, fn_name)(*args)
+    # Only the nonce read and the send need to be serialized across workers
+    gas_price = w3.eth.gas_price
+    with signer_lock():
+        nonce = w3.eth.get_transaction_count(account.address, "pending")
+        txn = contract_fn.build_transaction({
+            'chainId': chain_id,
+            'gas': 300000,
+            'gasPrice': gas_price,
+            'nonce': nonce
+        })
+        signed_txn = account.sign_transaction(txn)
+        tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+    logger.info(f"Nonce: {nonce}, Gas Price: {gas_price}")
+    return tx_hash
 
 class User(BaseModel):
     email: str
@@ -184,6 +284,13 @@ class QRCodeResponse(BaseModel):
     product_id: str
     verify_url: str
 
+class ServiceTokenRequest(BaseModel):
+    username: str = Field(..., description="Existing user the machine client acts as")
+    expires_in_days: int = Field(default=365, ge=1, le=3650, description="Token lifetime in days")
+
+class RevokeTokenRequest(BaseModel):
+    token: str = Field(..., description="Access or service token to revoke")
+
 
 
 def verify_password(plain_password, hashed_password):
@@ -192,19 +299,108 @@ def verify_password(plain_password, hashed_password):
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
+    # jti keeps tokens issued in the same second distinct, so revoking one
+    # digest never revokes another client's token
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+# Verified token cache
+# Claims that passed jwt.decode are cached by token digest until the earlier
+# of the token's exp and TOKEN_CACHE_TTL, so repeat requests from scanners and
+# dashboards skip HMAC verification and the user lookup. Revoked digests are
+# stored in SQLite and each worker reloads its in-memory set every
+# REVOCATION_REFRESH_SECONDS, which bounds how long a revoked token stays usable.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "300"))
+REVOCATION_REFRESH_SECONDS = int(os.getenv("REVOCATION_REFRESH_SECONDS", "5"))
+
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+revoked_tokens = set()
+# digest -> exp for revocations made by this worker, merged into every refresh
+# so a snapshot read just before revoke_token() commits cannot drop them
+_revoked_local = {}
+_revoked_loaded_at = 0.0
+
+def token_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def refresh_revoked_tokens(force=False):
+    global revoked_tokens, _revoked_loaded_at
+    now = time.time()
+    if not force and now - _revoked_loaded_at < REVOCATION_REFRESH_SECONDS:
+        return
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT digest FROM revoked_tokens WHERE exp > ?", (int(now),))
+        digests = {row["digest"] for row in c.fetchall()}
+    finally:
+        conn.close()
+    with _token_cache_lock:
+        for digest, exp in list(_revoked_local.items()):
+            if digest in digests or exp <= now:
+                del _revoked_local[digest]
+        digests |= _revoked_local.keys()
+        for digest in digests - revoked_tokens:
+            _token_cache.pop(digest, None)
+        revoked_tokens = digests
+        _revoked_loaded_at = now
+
+def revoke_token(token):
+    """Revoke a valid token for all workers. Returns False if it is already unusable."""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.PyJWTError:
+        return False
+    digest = token_digest(token)
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO revoked_tokens (digest, exp) VALUES (?, ?)",
+            (digest, int(payload["exp"]))
+        )
+        conn.execute("DELETE FROM revoked_tokens WHERE exp <= ?", (int(time.time()),))
+        conn.commit()
+    finally:
+        conn.close()
+    with _token_cache_lock:
+        _revoked_local[digest] = int(payload["exp"])
+        revoked_tokens.add(digest)
+        _token_cache.pop(digest, None)
+    return True
+
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
+    digest = token_digest(token)
+    refresh_revoked_tokens()
+    now = time.time()
+    with _token_cache_lock:
+        if digest in revoked_tokens:
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+        cached = _token_cache.get(digest)
+        if cached is not None:
+            expires_at, db_user = cached
+            if expires_at > now:
+                _token_cache.move_to_end(digest)
+                return db_user
+            del _token_cache[digest]
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get("sub")
-        if username not in fake_users_db:
+        db_user = get_user(username)
+        if db_user is None:
             raise HTTPException(status_code=401, detail="Invalid credentials")
-        return fake_users_db[username]
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    with _token_cache_lock:
+        if digest in revoked_tokens:
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+        _token_cache[digest] = (min(payload["exp"], now + TOKEN_CACHE_TTL), db_user)
+        _token_cache.move_to_end(digest)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return db_user
 
 
 @app.on_event("startup")
@@ -217,23 +413,18 @@ async def startup_event():
     else:
         print("✅ .env loaded successfully from", env_path)
 
-    # Check that the Infura key is actually loaded
-    infura_key = os.getenv("INFURA_API_KEY")
-    print("Loaded INFURA key:", infura_key)
-
-    # Validate Web3 connection
-    w3 = Web3(Web3.HTTPProvider(f"https://sepolia.infura.io/v3/{infura_key}"))
-
-    if not w3.is_connected():
-        print("❌ Web3 not connected! Check your INFURA_API_KEY or network.")
+    # Each worker opens its own provider once; signing is coordinated by signer_lock()
+    init_web3()
+    if contract is None:
+        print("❌ Web3 not connected! Check your INFURA_API_KEY, WEB3_PROVIDER_URL or network.")
     else:
-        print("✅ Connected to Sepolia network successfully.")
+        print(f"✅ Connected to chain {chain_id} successfully.")
 
 
 
 @app.post("/login")
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    db_user = fake_users_db.get(form_data.username)
+    db_user = get_user(form_data.username)
     if not db_user or not verify_password(form_data.password, db_user["hashed_password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     access_token = create_access_token(
@@ -242,29 +433,44 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
 
     return {"access_token": access_token, "token_type": "bearer", "role": db_user["role"]}
 
+@app.post("/service-token")
+def create_service_token(req: ServiceTokenRequest, user=Depends(get_current_user)):
+    """Issue a long-lived token for a machine client such as a scanner or dashboard."""
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    db_user = get_user(req.username)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    access_token = create_access_token(
+        data={"sub": db_user["username"], "role": db_user["role"], "svc": True},
+        expires_delta=timedelta(days=req.expires_in_days)
+    )
+    logger.info(f"🔑 Service token issued for {db_user['username']} by {user['username']}")
+    return {"access_token": access_token, "token_type": "bearer", "role": db_user["role"]}
+
+@app.post("/revoke-token")
+def revoke(req: RevokeTokenRequest, user=Depends(get_current_user)):
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if not revoke_token(req.token):
+        raise HTTPException(status_code=400, detail="Token is invalid or already expired")
+    logger.info(f"🚫 Token revoked by {user['username']}")
+    return {"message": "Token revoked"}
+
 @app.post("/add-spice")
 def add_spice(product: SpiceProduct, user=Depends(get_current_user)):
     if user["role"] not in ["admin", "producer"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     try:
-        nonce = w3.eth.get_transaction_count(account.address)
-        txn = contract.functions.registerProduct(
+        tx_hash = send_contract_tx(
+            "registerProduct",
             product.product_id,
             product.name,
             product.batch,
             product.manufacturer,
             product.saffron_region,
             product.harvest_season
-        ).build_transaction({
-            'chainId': 11155111,
-            'gas': 300000,
-            'gasPrice': w3.eth.gas_price,
-            'nonce': nonce
-        })
-        logger.info(f"Nonce: {nonce}, Gas Price: {w3.eth.gas_price}")
-
-        signed_txn = w3.eth.account.sign_transaction(txn, private_key)
-        tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction).hex()
+        ).hex()
         receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
         if receipt.status == 0:
             raise Exception("Transaction failed")
@@ -298,19 +504,7 @@ def update_status(req: UpdateStatusRequest, user=Depends(get_current_user)):
     try:
         logger.info(f"🔄 Updating status for product {req.product_id} to '{req.status}' by {user['username']}")
         
-        nonce = w3.eth.get_transaction_count(account.address)
-        txn = contract.functions.updateProductStatus(
-            req.product_id, 
-            req.status
-        ).build_transaction({
-            'chainId': 11155111,
-            'gas': 300000,
-            'gasPrice': w3.eth.gas_price,
-            'nonce': nonce
-        })
-
-        signed_txn = w3.eth.account.sign_transaction(txn, private_key)
-        tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+        tx_hash = send_contract_tx("updateProductStatus", req.product_id, req.status)
         logger.info(f"✅ Status updated successfully for {req.product_id}. TX: {tx_hash.hex()}")
         
         return {
@@ -383,21 +577,13 @@ def add_trace(trace: TraceRecord, user=Depends(get_current_user)):
     try:
         logger.info(f"🧩 Adding trace for {trace.product_id} → {trace.stage} at {trace.location}")
 
-        nonce = w3.eth.get_transaction_count(account.address)
-        txn = contract.functions.addTraceRecord(
+        tx_hash = send_contract_tx(
+            "addTraceRecord",
             trace.product_id,
             trace.stage,
             trace.company,
             trace.location
-        ).build_transaction({
-            'chainId': 11155111,
-            'gas': 300000,
-            'gasPrice': w3.eth.gas_price,
-            'nonce': nonce
-        })
-
-        signed_txn = w3.eth.account.sign_transaction(txn, private_key)
-        tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+        )
         logger.info(f"✅ Trace added successfully for {trace.product_id}. TX: {tx_hash.hex()}")
 
         return {
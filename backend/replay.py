@@ -0,0 +1,212 @@
+"""
+Replay traffic recorded by TrafficCaptureMiddleware against a backend.
+
+Start the backend pointed at a local chain, then replay a capture file:
+
+    npx hardhat node
+    npx hardhat run scripts/deploy.js --network localhost
+    WEB3_PROVIDER_URL=http://127.0.0.1:8545 uvicorn main:app --port 8000
+    python replay.py capture.jsonl --speed 10 --seed
+
+Requests are sent with a token for the role recorded in the capture, minted
+through /service-token for the users given by --role-user. Prints request
+count, error rate, latency percentiles and send lag per route.
+"""
+import re
+import json
+import time
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+PATH_PARAM = re.compile(r"\{(\w+)(?::\w+)?\}")
+UNMATCHED_ROUTE = "<unmatched>"
+INVALID_TOKEN = "invalid-replay-token"
+DEFAULT_ROLE_USERS = {
+    "admin": "admin@example.com",
+    "producer": "producer@example.com",
+    "seller": "seller@example.com",
+    "consumer": "consumer@example.com",
+}
+
+
+def load_capture(path):
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return sorted(entries, key=lambda e: e["ts"])
+
+
+def build_path(entry):
+    params = entry.get("p", {})
+    return PATH_PARAM.sub(lambda m: str(params.get(m.group(1), m.group(1))), entry["r"])
+
+
+def login(base_url, username, password):
+    response = requests.post(f"{base_url}/login", data={"username": username, "password": password})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+def role_tokens(base_url, admin_token, role_users):
+    """Mint a short-lived service token for each role the capture uses."""
+    tokens = {"invalid": INVALID_TOKEN}
+    for role, username in role_users.items():
+        response = requests.post(
+            f"{base_url}/service-token",
+            headers={"Authorization": f"Bearer {admin_token}"},
+            json={"username": username, "expires_in_days": 1},
+        )
+        response.raise_for_status()
+        tokens[role] = response.json()["access_token"]
+    return tokens
+
+
+def caller_token(entry, tokens, admin_token):
+    role = entry.get("a")
+    if not role:
+        return None
+    # Captures from before roles were recorded only stored a bearer flag
+    if role == 1:
+        return admin_token
+    return tokens[role]
+
+
+def seed_products(session, base_url, token, entries):
+    """
+    Register product ids the capture reads or updates but never creates, so
+    reads hit real data and the replayed /add-spice calls still succeed.
+    """
+    product_ids = set()
+    created = set()
+    for entry in entries:
+        for source in (entry.get("p", {}), entry.get("b", {})):
+            if isinstance(source, dict) and isinstance(source.get("product_id"), str):
+                if entry["r"] == "/add-spice":
+                    created.add(source["product_id"])
+                else:
+                    product_ids.add(source["product_id"])
+    product_ids -= created
+    failures = defaultdict(int)
+    for product_id in sorted(product_ids):
+        response = session.post(f"{base_url}/add-spice", headers={"Authorization": f"Bearer {token}"}, json={
+            "product_id": product_id,
+            "name": "Replay Saffron",
+            "batch": "REPLAY",
+            "manufacturer": "Replay Co",
+            "saffron_region": "Replay",
+            "harvest_season": 2024,
+        })
+        if response.status_code >= 300:
+            failures[response.status_code] += 1
+    failed = sum(failures.values())
+    print(f"Seeded {len(product_ids) - failed} of {len(product_ids)} products")
+    if failed:
+        statuses = ", ".join(f"{status}: {count}" for status, count in sorted(failures.items()))
+        print(f"WARNING: {failed} seed requests failed ({statuses}); reads of those ids will 404")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def replay(entries, base_url, tokens, admin_token, username, password, speed, concurrency):
+    results = defaultdict(list)
+    results_lock = threading.Lock()
+    local = threading.local()
+
+    def send(entry, scheduled):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        route = f"{entry['m']} {entry['r']}"
+        url = f"{base_url}{build_path(entry)}"
+        token = caller_token(entry, tokens, admin_token)
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        kwargs = {"headers": headers, "params": entry.get("q")}
+        if entry["r"] == "/login":
+            kwargs["data"] = {"username": username, "password": password}
+        elif "b" in entry:
+            kwargs["json"] = entry["b"]
+        # Latency counts from the scheduled send time, so time spent queued
+        # behind a saturated pool shows up in the percentiles
+        lag_ms = (time.perf_counter() - scheduled) * 1000
+        try:
+            status = local.session.request(entry["m"], url, timeout=60, **kwargs).status_code
+        except requests.RequestException:
+            status = None
+        latency_ms = (time.perf_counter() - scheduled) * 1000
+        with results_lock:
+            results[route].append((latency_ms, status, lag_ms))
+
+    t0 = entries[0]["ts"]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for entry in entries:
+            scheduled = started + (entry["ts"] - t0) / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, entry, scheduled)
+    return results, time.perf_counter() - started
+
+
+def report(results, elapsed):
+    total = sum(len(v) for v in results.values())
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)\n")
+    print(f"{'route':<32} {'count':>7} {'errors':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'p99 lag':>9}")
+    for route in sorted(results):
+        samples = results[route]
+        latencies = sorted(latency for latency, _, _ in samples)
+        lags = sorted(lag for _, _, lag in samples)
+        errors = sum(1 for _, status, _ in samples if status is None or status >= 400)
+        print(f"{route:<32} {len(samples):>7} {errors / len(samples):>7.1%} "
+              f"{percentile(latencies, 50):>9.1f} {percentile(latencies, 95):>9.1f} "
+              f"{percentile(latencies, 99):>9.1f} {percentile(lags, 99):>9.1f}")
+    print("\nLatency is measured from each request's scheduled send time; "
+          "lag is how late it actually left the client.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured API traffic")
+    parser.add_argument("capture", help="JSON lines file written by TrafficCaptureMiddleware")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier, e.g. 1, 10, 100")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--username", default="admin@example.com")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--seed", action="store_true", help="Register captured product ids before replaying")
+    parser.add_argument("--role-user", action="append", default=[], metavar="ROLE=USERNAME",
+                        help="User to replay a recorded role as (defaults to the demo users)")
+    args = parser.parse_args()
+
+    entries = load_capture(args.capture)
+    unmatched = [e for e in entries if e["r"] == UNMATCHED_ROUTE]
+    entries = [e for e in entries if e["r"] != UNMATCHED_ROUTE]
+    if not entries:
+        print("Capture file has no replayable requests")
+        return
+    role_users = dict(DEFAULT_ROLE_USERS)
+    role_users.update(dict(pair.split("=", 1) for pair in args.role_user))
+    used_roles = {e["a"] for e in entries if isinstance(e.get("a"), str) and e["a"] != "invalid"}
+    missing = used_roles - role_users.keys()
+    if missing:
+        raise SystemExit(f"No replay user for roles {sorted(missing)}, pass --role-user ROLE=USERNAME")
+    base_url = args.base_url.rstrip("/")
+    admin_token = login(base_url, args.username, args.password)
+    tokens = role_tokens(base_url, admin_token, {r: u for r, u in role_users.items() if r in used_roles})
+    if args.seed:
+        seed_products(requests.Session(), base_url, admin_token, entries)
+    results, elapsed = replay(entries, base_url, tokens, admin_token, args.username, args.password,
+                              args.speed, args.concurrency)
+    report(results, elapsed)
+    if unmatched:
+        print(f"Skipped {len(unmatched)} requests that matched no route when captured")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
+import time
 import pytest
+from datetime import timedelta
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
 from fastapi.testclient import TestClient
-from main import app
+import main
+from main import app, create_access_token, revoke_token, get_current_user, token_digest
 
 client = TestClient(app)
 
@@ -76,5 +81,174 @@ def test_generate_qr_unauthorized():
     })
     assert response.status_code == 401
 
+def test_demo_users_seeded_once():
+    """Test demo users are stored in SQLite and not re-hashed on re-init"""
+    from main import init_users, get_user
+    before = get_user("admin@example.com")
+    init_users()
+    after = get_user("admin@example.com")
+    assert before is not None
+    assert after["hashed_password"] == before["hashed_password"]
+    assert after["role"] == "admin"
+
+def test_signer_lock_serializes_nonces(monkeypatch, tmp_path):
+    """Test concurrent sends read the nonce under the signer lock and get consecutive nonces"""
+    from contextlib import contextmanager
+    from concurrent.futures import ThreadPoolExecutor
+    from types import SimpleNamespace
+
+    chain = {"pending": 0, "held": 0, "nonces": []}
+    original_lock = main.signer_lock
+
+    @contextmanager
+    def tracking_lock():
+        with original_lock():
+            chain["held"] += 1
+            try:
+                yield
+            finally:
+                chain["held"] -= 1
+
+    def get_transaction_count(address, block):
+        assert chain["held"] == 1
+        time.sleep(0.05)
+        return chain["pending"]
+
+    def send_raw_transaction(raw):
+        assert chain["held"] == 1
+        chain["nonces"].append(raw)
+        chain["pending"] += 1
+        return b"\x01"
+
+    def register_product(*args):
+        return SimpleNamespace(build_transaction=lambda tx: tx)
+
+    monkeypatch.setattr(main, "SIGNER_LOCK_PATH", str(tmp_path / "signer.lock"))
+    monkeypatch.setattr(main, "signer_lock", tracking_lock)
+    monkeypatch.setattr(main, "w3", SimpleNamespace(eth=SimpleNamespace(
+        gas_price=1,
+        get_transaction_count=get_transaction_count,
+        send_raw_transaction=send_raw_transaction,
+    )))
+    monkeypatch.setattr(main, "account", SimpleNamespace(
+        address="0xabc",
+        sign_transaction=lambda tx: SimpleNamespace(raw_transaction=tx["nonce"]),
+    ))
+    monkeypatch.setattr(main, "contract", SimpleNamespace(
+        functions=SimpleNamespace(registerProduct=register_product)
+    ))
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(main.send_contract_tx, "registerProduct", f"P{i}") for i in range(2)]
+        for future in futures:
+            future.result()
+    assert sorted(chain["nonces"]) == [0, 1]
+
+def test_traffic_capture_anonymize():
+    """Test captured parameters are anonymized consistently"""
+    from traffic_capture import anonymize
+    first = anonymize({"product_id": "TUR001", "harvest_season": 2024}, "salt")
+    second = anonymize({"product_id": "TUR001"}, "salt")
+    assert first["product_id"] == second["product_id"]
+    assert first["product_id"].startswith("anon-")
+    assert "TUR001" not in first["product_id"]
+    assert first["harvest_season"] == 2024
+
+def test_traffic_capture_middleware(tmp_path):
+    """Test captured lines use route templates and caller roles and never record form bodies"""
+    import json
+    from traffic_capture import TrafficCaptureMiddleware
+    capture_path = tmp_path / "capture.jsonl"
+    capture_client = TestClient(TrafficCaptureMiddleware(app, path=str(capture_path), salt="salt"))
+    token = create_access_token(data={"sub": "admin@example.com", "role": "admin"})
+    capture_client.get("/verify/TUR001", headers={"Authorization": f"Bearer {token}"})
+    capture_client.post("/login", data={"username": "admin@example.com", "password": "admin"})
+    capture_client.get("/no-such-route")
+    capture_client.get("/verify/TUR001", headers={"Authorization": "Bearer forged"})
+    verify_entry, login_entry, unmatched_entry, rejected_entry = [
+        json.loads(line) for line in capture_path.read_text().splitlines()
+    ]
+    assert verify_entry["r"] == "/verify/{product_id}"
+    assert verify_entry["p"]["product_id"].startswith("anon-")
+    assert verify_entry["a"] == "admin"
+    assert unmatched_entry["r"] == "<unmatched>"
+    assert rejected_entry["a"] == "invalid"
+    assert login_entry["r"] == "/login"
+    assert "b" not in login_entry
+    assert "a" not in login_entry
+    assert "admin@example.com" not in capture_path.read_text()
+
+def test_revoked_token_rejected_after_cache_hit():
+    """Test a cached token stops working once revoked"""
+    token = create_access_token(data={"sub": "seller@example.com", "role": "seller"})
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post("/generate-qr", headers=headers, json={"product_id": "TUR001"})
+    assert response.status_code == 200
+    assert revoke_token(token)
+    response = client.post("/generate-qr", headers=headers, json={"product_id": "TUR001"})
+    assert response.status_code == 401
+
+def auth_headers(email, role):
+    token = create_access_token(data={"sub": email, "role": role})
+    return {"Authorization": f"Bearer {token}"}
+
+def test_tokens_are_unique():
+    """Test tokens issued in the same second differ"""
+    data = {"sub": "admin@example.com", "role": "admin"}
+    assert create_access_token(data=data) != create_access_token(data=data)
+
+def test_cached_token_expires_at_exp(monkeypatch):
+    """Test a cached token stops working once its exp passes"""
+    import jwt
+    token = create_access_token(data={"sub": "admin@example.com", "role": "admin"},
+                                expires_delta=timedelta(seconds=60))
+    exp = jwt.decode(token, main.SECRET_KEY, algorithms=[main.ALGORITHM])["exp"]
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    assert get_current_user(credentials)["username"] == "admin@example.com"
+    assert main._token_cache[token_digest(token)][0] == exp
+
+    # Move both the cache clock and jwt's exp check two minutes ahead, past exp
+    real_time, real_decode = time.time, jwt.decode
+    monkeypatch.setattr(main.time, "time", lambda: real_time() + 120)
+    monkeypatch.setattr(main.jwt, "decode", lambda *args, **kwargs: real_decode(*args, leeway=-120, **kwargs))
+    with pytest.raises(HTTPException) as exc:
+        get_current_user(credentials)
+    assert exc.value.status_code == 401
+    assert token_digest(token) not in main._token_cache
+
+def test_token_cache_is_bounded(monkeypatch):
+    """Test the token cache evicts least recently used entries"""
+    monkeypatch.setattr(main, "TOKEN_CACHE_SIZE", 3)
+    main._token_cache.clear()
+    tokens = [create_access_token(data={"sub": "admin@example.com", "role": "admin"}) for _ in range(5)]
+    for token in tokens:
+        get_current_user(HTTPAuthorizationCredentials(scheme="Bearer", credentials=token))
+    assert len(main._token_cache) == 3
+    assert token_digest(tokens[0]) not in main._token_cache
+    assert token_digest(tokens[-1]) in main._token_cache
+
+def test_service_token_admin_only():
+    """Test only admins can issue service tokens"""
+    response = client.post("/service-token", headers=auth_headers("seller@example.com", "seller"),
+                           json={"username": "consumer@example.com"})
+    assert response.status_code == 403
+
+def test_service_token_works():
+    """Test an issued service token authenticates as the target user"""
+    response = client.post("/service-token", headers=auth_headers("admin@example.com", "admin"),
+                           json={"username": "consumer@example.com", "expires_in_days": 30})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["role"] == "consumer"
+    response = client.post("/generate-qr", headers={"Authorization": f"Bearer {data['access_token']}"},
+                           json={"product_id": "TUR001"})
+    assert response.status_code == 200
+
+def test_revoke_invalid_token():
+    """Test revoking a malformed token is rejected"""
+    response = client.post("/revoke-token", headers=auth_headers("admin@example.com", "admin"),
+                           json={"token": "not-a-token"})
+    assert response.status_code == 400
+
 if __name__ == "__main__":
     pytest.main([__file__])
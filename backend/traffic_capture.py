@@ -0,0 +1,124 @@
+import os
+import json
+import hmac
+import time
+import hashlib
+from urllib.parse import parse_qsl
+
+import jwt
+from starlette.routing import Match
+
+# Request bodies larger than this are recorded without their fields
+MAX_CAPTURED_BODY = 64 * 1024
+# Route recorded for requests that match no API route; replay.py skips these
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+def anonymize(value, salt):
+    """Replace string values with a stable keyed digest, keeping the structure."""
+    if isinstance(value, str):
+        digest = hmac.new(salt.encode(), value.encode(), hashlib.sha256).hexdigest()
+        return f"anon-{digest[:12]}"
+    if isinstance(value, dict):
+        return {k: anonymize(v, salt) for k, v in value.items()}
+    if isinstance(value, list):
+        return [anonymize(v, salt) for v in value]
+    return value
+
+
+class TrafficCaptureMiddleware:
+    """
+    ASGI middleware that appends one JSON line per HTTP request to `path`.
+    Each line holds the route template, status, duration and anonymized
+    path, query and JSON body parameters. Form bodies (e.g. /login) and
+    auth headers are never written. For bearer requests only the token's
+    role claim is kept, or "invalid" if the token was rejected.
+    """
+
+    def __init__(self, app, path, salt):
+        self.app = app
+        self.path = path
+        self.salt = salt
+        # One append-mode fd per process; each line goes out in a single O_APPEND
+        # write, so lines stay whole when several workers share the file
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.time()
+        start = time.perf_counter()
+        body_parts = []
+        body = {"size": 0}
+        status = {"code": 500}
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request" and body["size"] <= MAX_CAPTURED_BODY:
+                chunk = message.get("body", b"")
+                body["size"] += len(chunk)
+                if body["size"] <= MAX_CAPTURED_BODY:
+                    body_parts.append(chunk)
+                else:
+                    body_parts.clear()
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            self.record(scope, started, duration_ms, status["code"], b"".join(body_parts))
+
+    def resolve_route(self, scope):
+        app = scope.get("app")
+        if app is not None:
+            for route in app.router.routes:
+                match, child_scope = route.matches(scope)
+                if match == Match.FULL:
+                    return route.path, child_scope.get("path_params", {})
+        return UNMATCHED_ROUTE, {}
+
+    def caller_role(self, token, status_code):
+        # The signature was already checked by the route; a rejected token is
+        # recorded as "invalid" so replay sends a bad token too
+        if status_code == 401:
+            return "invalid"
+        try:
+            claims = jwt.decode(token, options={"verify_signature": False})
+        except jwt.PyJWTError:
+            return "invalid"
+        return claims.get("role") or "invalid"
+
+    def record(self, scope, started, duration_ms, status_code, body):
+        route, path_params = self.resolve_route(scope)
+        headers = dict(scope.get("headers") or [])
+        entry = {
+            "ts": round(started, 3),
+            "m": scope["method"],
+            "r": route,
+            "s": status_code,
+            "d": round(duration_ms, 2),
+        }
+        if path_params:
+            entry["p"] = anonymize({k: str(v) for k, v in path_params.items()}, self.salt)
+        query = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        if query:
+            entry["q"] = anonymize(query, self.salt)
+        authorization = headers.get(b"authorization", b"")
+        if authorization.lower().startswith(b"bearer "):
+            entry["a"] = self.caller_role(authorization[7:].decode("latin-1"), status_code)
+        content_type = headers.get(b"content-type", b"")
+        if body and content_type.startswith(b"application/json"):
+            try:
+                entry["b"] = anonymize(json.loads(body), self.salt)
+            except ValueError:
+                pass
+
+        os.write(self.fd, (json.dumps(entry, separators=(",", ":")) + "\n").encode())